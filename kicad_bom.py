@@ -2,9 +2,12 @@
 import re
 import os
 import sys
+import csv
 import glob
+import sqlite3
 import xlsxwriter
 
+from urllib.request import pathname2url
 from configparser import ConfigParser, ParsingError,ExtendedInterpolation
 from collections import OrderedDict
 
@@ -12,24 +15,38 @@ term_regex = r'''(?mx)
     \s*(?:
         (?P<brackl>\()|
         (?P<brackr>\))|
-        (?P<sq>"[^"]*")|
+        (?P<sq>"(?:[^"\\]|\\.)*")|
         (?P<s>[^(^)\s]+)
        )'''
 
-def parse_sexp(sexp):
+sexp_escapes = {'n': '\n', 't': '\t', '"': '"', '\\': '\\'}
+
+def unquote_sexp(s):
+    return re.sub(r'\\(.)', lambda m: sexp_escapes.get(m.group(1), m.group(0)), s[1:-1])
+
+def quote_sexp(s):
+    return '"' + s.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+
+def parse_sexp(sexp, spans = None):
+    # if spans is a dict, offsets (start, end) of the top level elements are stored there by index
     stack = []
+    starts = []
     out = []
     for termtypes in re.finditer(term_regex, sexp):
         term, value = [(t,v) for t,v in termtypes.groupdict().items() if v][0]
         if   term == 'brackl':
             stack.append(out)
+            starts.append(termtypes.start(term))
             out = []
         elif term == 'brackr':
             assert stack, "Trouble with nesting of brackets"
             tmpout, out = out, stack.pop(-1)
+            start = starts.pop(-1)
+            if spans is not None and len(stack) == 1:
+                spans[len(out)] = (start, termtypes.end(term))
             out.append(tmpout)
         elif term == 'sq':
-            out.append(value[1:-1])
+            out.append(unquote_sexp(value))
         elif term == 's':
             out.append(value)
         else:
@@ -41,12 +58,35 @@ def print_sexp(exp):
     out = ''
     if type(exp) == type([]):
         out += '(' + ' '.join(print_sexp(x) for x in exp) + ')'
-    elif type(exp) == type('') and re.search(r'[\s()]', exp):
-        out += '"%s"' % repr(exp)[1:-1].replace('"', '\"')
+    elif type(exp) == type('') and (exp == '' or re.search(r'[\s()"\\]', exp)):
+        out += quote_sexp(exp)
     else:
         out += '%s' % exp
     return out
 
+def sexp_children(fragment):
+    # direct children of a single expression with their offsets and atoms (atoms as in the source)
+    res = []
+    depth = 0
+    for t in re.finditer(term_regex, fragment):
+        term = t.lastgroup
+        if term == 'brackl':
+            depth += 1
+            if depth == 2:
+                res.append({'start': t.start(term), 'end': -1, 'atoms': []})
+        elif term == 'brackr':
+            if depth == 2:
+                res[-1]['end'] = t.end(term)
+            depth -= 1
+        elif depth == 2:
+            res[-1]['atoms'].append((t.group(term), t.start(term), t.end(term)))
+    return res
+
+def sexp_atom(token):
+    if token.startswith('"'):
+        return unquote_sexp(token)
+    return token
+
 # helper functions 
 
 def sortRef(lst):
@@ -58,6 +98,30 @@ def listtonumbers(l):
         res.append(float(i))
     return res
 
+value_prefixes = {'p':1e-12, 'n':1e-9, 'u':1e-6, '\u00b5':1e-6, '\u03bc':1e-6, 'm':1e-3,
+                  'r':1, 'R':1, 'k':1e3, 'K':1e3, 'M':1e6, 'G':1e9}
+
+def parseValue(v):
+    # 10k -> (10000, ''), 4k7 -> (4700, ''), 100nF -> (1e-07, 'F'), 4R7 -> (4.7, '\u03a9'); (None, '') if there is no number
+    if v is None:
+        return (None,'')
+    m = re.match(r'\s*(\d+(?:[.,]\d+)?)\s*([pnu\u00b5\u03bcmrRkKMG]?)(\d*)\s*(F|H|V|A|W|Hz|[Oo]hms?|\u03a9)?(?:$|[\s/,])',str(v))
+    if not m:
+        return (None,'')
+    num = m.group(1).replace(',','.')
+    if m.group(3) and '.' not in num:
+        num += '.' + m.group(3)
+    unit = m.group(4) or ''
+    if unit.lower().startswith('ohm') or m.group(2) in ('r','R'):
+        unit = '\u03a9'
+    return (float('%.6g' % (float(num) * value_prefixes.get(m.group(2),1))),unit)
+
+def normPackage(p):
+    return re.sub(r'[\s_-]','',str(p or '')).lower()
+
+def normValue(v):
+    return re.sub(r'\s','',str(v or ''))
+
 # class definitions
 
 class Module:
@@ -65,6 +129,8 @@ class Module:
         self.module = mod
         self.properties = {}
         self.used = False
+        self.span = None
+        self.edits = OrderedDict()
     
     def getAttr(self,attribute):
         if attribute == "reference":
@@ -96,6 +162,68 @@ class Module:
                     break
         return self.properties[attr]
 
+    def setProperty(self,attr,value):
+        # in kicad 7 Reference and Value are fp_text, not properties
+        if attr == 'Reference':
+            current = self.getRef()
+        elif attr == 'Value':
+            current = self.getValue()
+        else:
+            current = self.getProperty(attr)
+        if current != value:
+            self.properties[attr] = value
+            self.edits[attr] = value
+            if attr == 'Reference':
+                self.ref = value
+            elif attr == 'Value':
+                self.val = value
+
+    def newProperty(self,attr,value,full):
+        # kicad 7 footprints keep bare properties, kicad 9 ones need position, layer and effects
+        if not full:
+            return '(property {0} {1})'.format(quote_sexp(attr),quote_sexp(value))
+        if self.getSide() == 'bottom':
+            layer, justify = 'B.Fab', ' (justify mirror)'
+        else:
+            layer, justify = 'F.Fab', ''
+        return ('(property {0} {1} (at 0 0 0) (layer "{2}") (hide yes) '
+                '(effects (font (size 1 1) (thickness 0.15)){3}))').format(quote_sexp(attr),quote_sexp(value),layer,justify)
+
+    def annotatedText(self,source):
+        # only this footprint is re-read; untouched parts of it are copied as they are
+        start, end = self.span
+        fragment = source[start:end]
+        children = sexp_children(fragment)
+        edits = OrderedDict(self.edits)
+        repl = []
+        full = False
+        anchor = children[-1] if children else None
+        for c in children:
+            atoms = c['atoms']
+            if len(atoms) > 0 and atoms[0][0] in ('property','fp_text'):
+                anchor = c
+            if len(atoms) >= 3 and atoms[0][0] in ('property','fp_text'):
+                name = sexp_atom(atoms[1][0])
+                if atoms[0][0] == 'fp_text':
+                    name = {'reference':'Reference','value':'Value'}.get(name)
+                elif name == 'Reference':
+                    full = True
+                if name in edits:
+                    repl.append((atoms[2][1],atoms[2][2],quote_sexp(edits.pop(name))))
+        if edits:
+            if anchor:
+                pos = anchor['end']
+                line = fragment.rfind('\n',0,anchor['start']) + 1
+                indent = fragment[line:anchor['start']]
+                sep = '\n' + indent if indent.strip() == '' else ' '
+            else:
+                pos = len(fragment) - 1
+                sep = ' '
+            repl.append((pos,pos,''.join(sep + self.newProperty(k,v,full) for k,v in edits.items())))
+        for b,e,text in sorted(repl,reverse = True):
+            fragment = fragment[:b] + text + fragment[e:]
+        return fragment
+
     def getRef(self):
         if not hasattr(self,'ref'):
             self.ref = ""
@@ -285,18 +413,20 @@ class Board:
     def __init__(self,pname,options):
         self.options = options
         self.workbook = False
-        with open(pname+".kicad_pcb", "r") as f:
-            brd = f.read()
-            self.brd = parse_sexp(brd)
+        self.spans = {}
+        with open(pname+".kicad_pcb", "r", encoding='utf-8', newline='') as f:
+            self.source = f.read()
+            self.brd = parse_sexp(self.source,self.spans)
             f.close()
         #with open(pname+".net", "r") as f:
         #    net = f.read()
         #    self.net = parse_sexp(net)
         #    f.close()
         self.modules = []
-        for l in self.brd:
+        for n,l in enumerate(self.brd):
             if l[0] == 'module' or l[0] == 'footprint':
                 m = Module(l)
+                m.span = self.spans.get(n)
                 for p in self.options.package_sub:
                     if re.match(p['match'],m.getPackage()):
                         m.package = p['repl']
@@ -375,6 +505,33 @@ class Board:
                 sect[s] = sorted(sect[s],key = lambda x: str(x['key']))        
         self.contents = sect
         
+    def enrichContents(self):
+        try:
+            db = openPartsDB(self.options.partsdb,self.options.partsdb_table)
+        except sqlite3.Error:
+            print('Error in parts database:',sys.exc_info()[1])
+            return
+        rows = [i for s in self.contents for i in self.contents[s]]
+        # values written without unit get one from the category of the part
+        units = {'resistors':'\u03a9', 'capacitors':'F', 'inductances':'H'}
+        modules = {m.getRef(): m for m in self.modules}
+        keys = []
+        for i in rows:
+            m = modules.get(i['reference'].split(',')[0])
+            keys.append((i['package'],i['value'],units.get(m.elementCategory(self.options.categories),'') if m else ''))
+        found = db.lookup(set(keys))
+        # database column names are case insensitive, like in SQLite itself
+        names = {c['source'].lower(): c['source'] for c in self.options.columns if c['source']}
+        for i,key in zip(rows,keys):
+            part = found.get(key)
+            if not part:
+                continue
+            # properties from the board take precedence over the database
+            for k,v in part.items():
+                k = names.get(k.lower(),k)
+                if v is not None and (not k in i or i[k] == '' or i[k] == None):
+                    i[k] = v
+
     def prepareModule(self,module):
         modulerow = {'key': int('0'+''.join(re.findall(r'\d+', module.getRef()))), 'reference': [module.getRef()], 'package':module.getPackage(), 'value':module.getValue(),'quantity':1}
         for c in self.options.columns:
@@ -384,6 +541,61 @@ class Board:
                 modulerow[attr] = v
         return modulerow
     
+    def annotate(self):
+        for a in self.options.annotate:
+            for m in self.modules:
+                v = m.getAttr(a['attr'])
+                if v and re.fullmatch(a['match'],str(v)):
+                    for k,p in a['props'].items():
+                        m.setProperty(k,p)
+        if self.options.annotate_csv:
+            with open(self.options.annotate_csv, "r", encoding='utf-8-sig', newline='') as f:
+                reader = csv.reader(f)
+                header = [h.strip() for h in next(reader,[])]
+                rows = {}
+                used = set()
+                if len(header) < 2:
+                    print("Error in annotate file:",self.options.annotate_csv)
+                for r in reader:
+                    if len(r) == 0 or len(header) < 2:
+                        continue
+                    keys = r[0].split(',') if header[0] == 'reference' else [r[0]]
+                    for k in keys:
+                        rows.setdefault(k.strip(),[]).append(r)
+            for m in self.modules:
+                if not rows:
+                    break
+                key = str(m.getAttr(header[0]))
+                for r in rows.get(key,[]):
+                    for k,p in zip(header[1:],r[1:]):
+                        if k and p != '':
+                            m.setProperty(k,p)
+                used.add(key)
+            for k in rows:
+                if not k in used:
+                    print("Warning: no footprint with {0} {1} in annotate file".format(header[0],k))
+        for m in self.modules:
+            if m.edits and m.module[0] == 'module':
+                print("Warning: {0} not annotated, KiCad 5 footprints have no properties".format(m.getRef()))
+                m.edits.clear()
+
+    def writeAnnotated(self):
+        # unchanged parts of the board are copied from the source, only edited footprints are rebuilt
+        filename = self.options.annotate_output
+        edited = sorted([m for m in self.modules if m.edits and m.span],key = lambda m: m.span[0])
+        if not edited:
+            print("Nothing to annotate,",filename,"not written")
+            return
+        pos = 0
+        with open(filename, "w", encoding='utf-8', newline='') as f:
+            for m in edited:
+                print('Annotated',m.getRef(),', '.join(m.edits))
+                f.write(self.source[pos:m.span[0]])
+                f.write(m.annotatedText(self.source))
+                pos = m.span[1]
+            f.write(self.source[pos:])
+            f.close()
+
     def hasSections(self):
         return len(self.options.sections) > 0
     
@@ -416,6 +628,8 @@ class Board:
             worksheet.write(3,i,c['name'],colhdrfmt)
             i += 1
         self.prepareContents()
+        if self.options.partsdb:
+            self.enrichContents()
         row = 4
         n = 1
         sections = self.options.sections
@@ -519,6 +733,120 @@ class Board:
                 n += 1
                 row += 1
     
+class PartsDB:
+    # local parts database: table with package and value columns plus any others (mpn, price, stock...)
+    # the table is only read, normalized search keys are kept in a separate file next to it
+    cachesize = 4096
+    batchsize = 500
+
+    def __init__(self,filename,table = 'parts'):
+        self.table = table
+        self.cache = OrderedDict()
+        self.db = sqlite3.connect('file:{0}?mode=ro'.format(pathname2url(os.path.abspath(filename))),uri = True)
+        columns = [c[1] for c in self.db.execute('PRAGMA main.table_info("{0}")'.format(table))]
+        if not 'package' in columns or not 'value' in columns:
+            raise sqlite3.DatabaseError('table {0} must have package and value columns'.format(table))
+        self.columns = [c for c in columns if c not in ('package','value')]
+        try:
+            self.db.execute('SELECT rowid FROM main."{0}" LIMIT 1'.format(table))
+        except sqlite3.OperationalError:
+            raise sqlite3.DatabaseError('table {0} has no rowid (WITHOUT ROWID tables are not supported)'.format(table))
+        keys = os.path.abspath(filename+'.keys')
+        if os.path.exists(keys):
+            writable = os.path.isfile(keys) and os.access(keys,os.W_OK)
+        else:
+            writable = os.access(os.path.dirname(keys),os.W_OK)
+        if writable:
+            try:
+                self.db.execute('ATTACH DATABASE ? AS keys',('file:{0}?mode=rwc'.format(pathname2url(keys)),))
+            except sqlite3.Error:
+                writable = False
+        if not writable:
+            print('Warning: cannot write {0}.keys, parts database keys are kept in memory'.format(filename))
+            self.db.execute("ATTACH DATABASE ':memory:' AS keys")
+        self.prepare()
+
+    def prepare(self):
+        # keys remember the package and value they were made from, so edited rows are refreshed
+        t = self.table
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS keys."{0}" (id INTEGER PRIMARY KEY, package, value, '
+                            'package_norm TEXT, value_norm TEXT, value_num REAL, value_unit TEXT)'.format(t))
+            stale = self.db.execute('SELECT p.rowid, p.package, p.value FROM main."{0}" p LEFT JOIN keys."{0}" k ON k.id = p.rowid '
+                                    'WHERE k.id IS NULL OR k.package IS NOT p.package OR k.value IS NOT p.value'.format(t)).fetchall()
+            if stale:
+                self.db.executemany('INSERT OR REPLACE INTO keys."{0}" VALUES (?,?,?,?,?,?,?)'.format(t),
+                                    [(r[0],r[1],r[2],normPackage(r[1]),normValue(r[2])) + parseValue(r[2]) for r in stale])
+            self.db.execute('DELETE FROM keys."{0}" WHERE id NOT IN (SELECT rowid FROM main."{0}")'.format(t))
+            self.db.execute('CREATE INDEX IF NOT EXISTS keys."{0}_norm" ON "{0}" (package_norm, value_norm)'.format(t))
+            self.db.execute('CREATE INDEX IF NOT EXISTS keys."{0}_num" ON "{0}" (package_norm, value_num, value_unit)'.format(t))
+
+    def lookup(self,keys):
+        # keys are (package, value, unit) with the unit expected when the value has none ('' if unknown),
+        # result maps them to a dict of database columns or None
+        res = {}
+        todo = {}
+        for k in keys:
+            n = (normPackage(k[0]),normValue(k[1]),k[2])
+            if n in self.cache:
+                self.cache.move_to_end(n)
+                res[k] = self.cache[n]
+            else:
+                todo.setdefault(n,[]).append(k)
+        todo = list(todo.items())
+        select = ''.join(', p."{0}"'.format(c) for c in self.columns)
+        for b in range(0,len(todo),self.batchsize):
+            batch = todo[b:b+self.batchsize]
+            lookup = []
+            for i,(n,ks) in enumerate(batch):
+                num, unit = parseValue(ks[0][1])
+                lookup.append((i,n[0],n[1],num,unit or n[2]))
+            found = {}
+            candidates = {}
+            with self.db:
+                self.db.execute('CREATE TEMP TABLE IF NOT EXISTS lookup (id INTEGER, package_norm TEXT, value_norm TEXT, '
+                                'value_num REAL, value_unit TEXT)')
+                self.db.execute('DELETE FROM temp.lookup')
+                self.db.executemany('INSERT INTO temp.lookup VALUES (?,?,?,?,?)',lookup)
+                # exact value first
+                sql = ('SELECT l.id{0} FROM temp.lookup l CROSS JOIN keys."{1}" k ON k.package_norm = l.package_norm '
+                       'AND k.value_norm = l.value_norm JOIN main."{1}" p ON p.rowid = k.id ORDER BY l.id, k.id').format(select,self.table)
+                for r in self.db.execute(sql):
+                    if not r[0] in found:
+                        found[r[0]] = dict(zip(self.columns,r[1:]))
+                # then the same numeric value written differently (10k vs 10000),
+                # units must agree unless one of the values has none
+                sql = ('SELECT l.id, k.value_unit{0} FROM temp.lookup l CROSS JOIN keys."{1}" k ON k.package_norm = l.package_norm '
+                       "AND k.value_num = l.value_num AND (k.value_unit = l.value_unit OR k.value_unit = '' OR l.value_unit = '') "
+                       'JOIN main."{1}" p ON p.rowid = k.id ORDER BY l.id, k.id').format(select,self.table)
+                for r in self.db.execute(sql):
+                    if not r[0] in found:
+                        candidates.setdefault(r[0],[]).append((r[1],dict(zip(self.columns,r[2:]))))
+            for i,c in candidates.items():
+                # a value without unit is ambiguous if it matches parts with different units (100nF and 100nH)
+                if len(set(u for u,_ in c if u)) > 1:
+                    print('Warning: {0} {1} matches parts with different units in the parts database'.format(batch[i][1][0][0],batch[i][1][0][1]))
+                else:
+                    found[i] = c[0][1]
+            for i,(n,ks) in enumerate(batch):
+                self.cache[n] = found.get(i)
+                if len(self.cache) > self.cachesize:
+                    self.cache.popitem(last = False)
+                for k in ks:
+                    res[k] = found.get(i)
+        return res
+
+partsdb_cache = {}
+
+def openPartsDB(filename,table = 'parts'):
+    # kept open for the whole process, so repeated BOMs reuse the cache
+    key = (os.path.abspath(filename),table)
+    if not os.path.isfile(filename):
+        raise sqlite3.OperationalError('no such file: '+filename)
+    if not key in partsdb_cache:
+        partsdb_cache[key] = PartsDB(filename,table)
+    return partsdb_cache[key]
+
 class Options:
     def __init__(self):
         self.config = ConfigParser(interpolation = ExtendedInterpolation(),allow_no_value=True)
@@ -629,6 +957,28 @@ class Options:
                     print("Error in category definition:",i)
                 else:
                     self.categories.append({'attr':attr.group(1),'match':"^"+attr.group(2)+"$",'category':self.config.get("categories",i)})
+        # back-annotation
+        self.annotate = []
+        if self.config.has_section("annotate"):
+            for i in self.config.options("annotate"):
+                attr = re.match(attr_template,i.strip())
+                v = self.config.get("annotate",i)
+                if attr == None or not v:
+                    print("Error in annotate definition:",i)
+                    continue
+                props = OrderedDict()
+                for p in v.split(';'):
+                    p = p.split(':',1)
+                    if len(p) == 2 and p[0].strip():
+                        props[p[0].strip()] = p[1].strip()
+                    else:
+                        print("Error in annotate definition:",i)
+                self.annotate.append({'attr':attr.group(1),'match':attr.group(2),'props':props})
+        self.annotate_csv = self.config.get("project","annotate_csv",fallback = '')
+        self.annotate_output = self.config.get("project","annotate_output",fallback = self.projectName+"_annotated.kicad_pcb")
+        # parts database
+        self.partsdb = self.config.get("project","partsdb",fallback = '')
+        self.partsdb_table = self.config.get("project","partsdb_table",fallback = 'parts')
         # formats
         self.formats = {}
         self.formats["header"] = {'bold': True, 'font_size':16, 'font_color': 'navy','underline':1}
@@ -674,3 +1024,6 @@ if __name__ == '__main__':
             options.config.get("project","positions") == "yes"):
         brd.addPlacement()
     brd.writeXLSX()
+    if options.annotate or options.annotate_csv:
+        brd.annotate()
+        brd.writeAnnotated()